@@ -0,0 +1,83 @@
+/// <reference types="vite/client" />
+import { convexTest } from "convex-test"
+import { expect, test, vi } from "vitest"
+import { internal } from "./_generated/api"
+import schema from "./schema"
+import {
+  createTestSelectionPeriod,
+  createTestTopics,
+  insertTestPreferences
+} from "./share/admin_helpers"
+import * as DeferredAssignment from "./schemas/DeferredAssignment"
+
+test("assignmentSolver: applyDeferredAssignment keeps ranks for duplicated allow-list entries", async () => {
+  vi.useFakeTimers()
+  const t = convexTest(schema, import.meta.glob("./**/*.*s"))
+
+  const semesterId = "2024-duplicate-allow-list"
+  const now = Date.now()
+  const futureClose = now + (30 * 24 * 60 * 60 * 1000)
+
+  const { periodId, deferredId, topicIds } = await t.run(async (ctx: any) => {
+    const [periodId, topicIds] = await Promise.all([
+      createTestSelectionPeriod(ctx, "test-user", semesterId, now, futureClose),
+      createTestTopics(ctx, "test-user", semesterId)
+    ])
+
+    // Experiment periods take their students from the allow list
+    await ctx.db.patch(periodId, { description: "Experiment EXCLUSIONS:[[0,1]]" })
+
+    await insertTestPreferences(ctx, [
+      { id: "DUP", topics: topicIds },
+      { id: "OTHER", topics: [...topicIds].reverse() }
+    ], semesterId)
+
+    // "DUP" appears twice, so studentIds is ["DUP", "OTHER", "DUP"]
+    for (const studentId of ["DUP", "OTHER", "DUP"]) {
+      await ctx.db.insert("periodStudentAllowList", {
+        selectionPeriodId: periodId,
+        studentId,
+        addedAt: now,
+        addedBy: "test@example.com",
+      })
+    }
+
+    const deferredId = await ctx.db.insert("deferredAssignments", DeferredAssignment.makePending({
+      kind: "cpsat",
+      periodId,
+      request: { num_students: 3, num_groups: topicIds.length, groups: [], exclude: [] },
+      createdAt: now
+    }))
+
+    return { periodId, deferredId, topicIds }
+  })
+
+  await t.action(internal.assignmentSolver.applyDeferredAssignment, {
+    deferredId,
+    data: {
+      assignments: [
+        { student_id: 0, group_id: 0 },
+        { student_id: 1, group_id: 0 },
+        { student_id: 2, group_id: 1 }
+      ]
+    }
+  })
+
+  const assignments = await t.run(async (ctx: any) =>
+    ctx.db
+      .query("assignments")
+      .withIndex("by_period", (q: any) => q.eq("periodId", periodId))
+      .collect()
+  )
+
+  const ranksFor = (studentId: string) =>
+    assignments
+      .filter((a: any) => a.studentId === studentId)
+      .map((a: any) => a.originalRank)
+      .sort((a: number, b: number) => a - b)
+
+  expect(ranksFor("DUP")).toEqual([1, 2])
+  expect(ranksFor("OTHER")).toEqual([topicIds.length])
+
+  vi.useRealTimers()
+})
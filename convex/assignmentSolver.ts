@@ -1,6 +1,6 @@
 "use node"
 
-import { internalAction } from "./_generated/server"
+import { internalAction, ActionCtx } from "./_generated/server"
 import { v } from "convex/values"
 import { internal } from "./_generated/api"
 import type { Id } from "./_generated/dataModel"
@@ -19,7 +19,12 @@ const GA_SERVICE_URL =
   "https://assignment-cpsat-production.up.railway.app"
 const DEFERRED_ASSIGNMENT_CALLBACK_PATH = "/deferredAssignments/callback"
 
+// Experiment data embedded in period descriptions, compiled once per module
+const EXCLUSIONS_PATTERN = /EXCLUSIONS:(\[\[.*?\]\])/
+const CRITERIA_PATTERN = /CRITERIA:(\{.*?\})/
+
 type AssignmentResult = Array<{ studentId: string; topicId: Id<"topics">; rank?: number }>
+type CriterionConfig = { type: string; min_ratio?: number }
 type SolverSettings = {
   rankingPercentage?: number
   maxTimeInSeconds?: number
@@ -45,64 +50,8 @@ export const solveAssignment = internalAction({
     }))
   },
   handler: async (ctx, args): Promise<AssignmentResult> => {
-    // Fetch all data needed for the solver
-    const period = await ctx.runQuery(internal.assignments.getPeriodForSolver, { periodId: args.periodId })
-    if (!period) {
-      throw new Error("Period not found")
-    }
-
-    const rankingsEnabled = period.rankingsEnabled !== false
-    const preferences: Array<Doc<"preferences">> = rankingsEnabled
-      ? await ctx.runQuery(internal.assignments.getPreferencesForSolver, { periodId: args.periodId })
-      : []
-    const topics: Array<Doc<"topics">> = await ctx.runQuery(internal.assignments.getTopicsForSolver, { periodId: args.periodId })
-    const studentAnswers: Array<Doc<"studentAnswers">> = await ctx.runQuery(internal.assignments.getStudentAnswersForSolver, { periodId: args.periodId })
-    const questions: Array<Doc<"questions"> | null> = await ctx.runQuery(internal.assignments.getQuestionsForSolver, { periodId: args.periodId })
-
-    if (topics.length === 0) {
-      throw new Error("No active topics found for assignment")
-    }
-
-    // Check if this is an experiment period (doesn't require topic preferences)
-    const isExperiment = period.description.includes("EXCLUSIONS:")
-
-    // Get unique student IDs - either from preferences or from access list for experiments
-    let studentIds: string[]
-    if (isExperiment || !rankingsEnabled) {
-      // For experiment periods, get students from access list
-      const accessList = await ctx.runQuery(internal.assignments.getAccessListForSolver, { periodId: args.periodId })
-      studentIds = accessList.map((a: any) => a.studentId)
-    } else {
-      // For normal periods, get students from preferences
-      studentIds = [...new Set(preferences.map((p: Doc<"preferences">) => p.studentId))]
-    }
-    
-    if (studentIds.length === 0) {
-      throw new Error("No students to assign")
-    }
-
-    // Fetch categories for criterion types
-    const allCategories = await ctx.runQuery(internal.constraints.getAllConstraintsForSolver, {
-      semesterId: period.semesterId
-    })
-
-    // Transform to CP-SAT format
-    const solverSettings = rankingsEnabled
-      ? args.settings
-      : args.settings
-        ? { ...args.settings, rankingPercentage: undefined }
-        : undefined
-
-    const cpSatInput = transformToCPSATFormat({
-      period,
-      preferences,
-      topics,
-      studentAnswers,
-      questions,
-      studentIds,
-      categories: allCategories,
-      settings: solverSettings
-    })
+    // Fetch all data needed for the solver and transform to CP-SAT format
+    const { topics, preferences, studentIds, cpSatInput } = await buildSolverInput(ctx, args.periodId, args.settings)
 
     // Call GA service
     try {
@@ -151,57 +100,7 @@ export const requestDeferredAssignment = internalAction({
     }))
   },
   handler: async (ctx, args): Promise<{ deferredId: Id<"deferredAssignments"> }> => {
-    const period = await ctx.runQuery(internal.assignments.getPeriodForSolver, { periodId: args.periodId })
-    if (!period) {
-      throw new Error("Period not found")
-    }
-
-    const rankingsEnabled = period.rankingsEnabled !== false
-    const preferences: Array<Doc<"preferences">> = rankingsEnabled
-      ? await ctx.runQuery(internal.assignments.getPreferencesForSolver, { periodId: args.periodId })
-      : []
-    const topics: Array<Doc<"topics">> = await ctx.runQuery(internal.assignments.getTopicsForSolver, { periodId: args.periodId })
-    const studentAnswers: Array<Doc<"studentAnswers">> = await ctx.runQuery(internal.assignments.getStudentAnswersForSolver, { periodId: args.periodId })
-    const questions: Array<Doc<"questions"> | null> = await ctx.runQuery(internal.assignments.getQuestionsForSolver, { periodId: args.periodId })
-
-    if (topics.length === 0) {
-      throw new Error("No active topics found for assignment")
-    }
-
-    const isExperiment = period.description.includes("EXCLUSIONS:")
-
-    let studentIds: string[]
-    if (isExperiment || !rankingsEnabled) {
-      const accessList = await ctx.runQuery(internal.assignments.getAccessListForSolver, { periodId: args.periodId })
-      studentIds = accessList.map((a: any) => a.studentId)
-    } else {
-      studentIds = [...new Set(preferences.map((p: Doc<"preferences">) => p.studentId))]
-    }
-
-    if (studentIds.length === 0) {
-      throw new Error("No students to assign")
-    }
-
-    const allCategories = await ctx.runQuery(internal.constraints.getAllConstraintsForSolver, {
-      semesterId: period.semesterId
-    })
-
-    const solverSettings = rankingsEnabled
-      ? args.settings
-      : args.settings
-        ? { ...args.settings, rankingPercentage: undefined }
-        : undefined
-
-    const cpSatInput = transformToCPSATFormat({
-      period,
-      preferences,
-      topics,
-      studentAnswers,
-      questions,
-      studentIds,
-      categories: allCategories,
-      settings: solverSettings
-    })
+    const { cpSatInput } = await buildSolverInput(ctx, args.periodId, args.settings)
 
     const { students, ...requestWithoutStudents } = cpSatInput
     const deferredId = await ctx.runMutation(internal.deferredAssignments.createDeferredAssignment, {
@@ -295,39 +194,7 @@ export const applyDeferredAssignment = internalAction({
       throw new Error("Deferred assignment not found")
     }
 
-    const period = await ctx.runQuery(internal.assignments.getPeriodForSolver, {
-      periodId: deferred.periodId
-    })
-    if (!period) {
-      throw new Error("Period not found")
-    }
-
-    const rankingsEnabled = period.rankingsEnabled !== false
-    const preferences: Array<Doc<"preferences">> = rankingsEnabled
-      ? await ctx.runQuery(internal.assignments.getPreferencesForSolver, { periodId: deferred.periodId })
-      : []
-    const topics: Array<Doc<"topics">> = await ctx.runQuery(internal.assignments.getTopicsForSolver, {
-      periodId: deferred.periodId
-    })
-
-    if (topics.length === 0) {
-      throw new Error("No active topics found for assignment")
-    }
-
-    const isExperiment = period.description.includes("EXCLUSIONS:")
-    let studentIds: string[]
-    if (isExperiment || !rankingsEnabled) {
-      const accessList = await ctx.runQuery(internal.assignments.getAccessListForSolver, {
-        periodId: deferred.periodId
-      })
-      studentIds = accessList.map((a: any) => a.studentId)
-    } else {
-      studentIds = [...new Set(preferences.map((p: Doc<"preferences">) => p.studentId))]
-    }
-
-    if (studentIds.length === 0) {
-      throw new Error("No students to assign")
-    }
+    const { topics, preferences, studentIds } = await loadSolverContext(ctx, deferred.periodId)
 
     const rawAssignments = args.data?.assignments
     if (!Array.isArray(rawAssignments) || rawAssignments.length === 0) {
@@ -355,6 +222,97 @@ export const applyDeferredAssignment = internalAction({
   }
 })
 
+/**
+ * Builds the solver criterion for a topic-specific category, keyed by criterion type.
+ */
+const TOPIC_CRITERION_BUILDERS: Partial<
+  Record<NonNullable<Doc<"categories">["criterionType"]>, (category: Doc<"categories">) => CriterionConfig>
+> = {
+  prerequisite: (category) => ({
+    type: "prerequisite",
+    min_ratio: category.minRatio ?? 0.5
+  }),
+  pull: () => ({ type: "pull" })
+}
+
+/**
+ * Loads the period, topics, preferences and student list shared by every solver action.
+ */
+async function loadSolverContext(ctx: ActionCtx, periodId: Id<"selectionPeriods">) {
+  const period = await ctx.runQuery(internal.assignments.getPeriodForSolver, { periodId })
+  if (!period) {
+    throw new Error("Period not found")
+  }
+
+  const rankingsEnabled = period.rankingsEnabled !== false
+  const preferences: Array<Doc<"preferences">> = rankingsEnabled
+    ? await ctx.runQuery(internal.assignments.getPreferencesForSolver, { periodId })
+    : []
+  const topics: Array<Doc<"topics">> = await ctx.runQuery(internal.assignments.getTopicsForSolver, { periodId })
+
+  if (topics.length === 0) {
+    throw new Error("No active topics found for assignment")
+  }
+
+  // Check if this is an experiment period (doesn't require topic preferences)
+  const isExperiment = period.description.includes("EXCLUSIONS:")
+
+  // Get unique student IDs - either from preferences or from access list for experiments
+  let studentIds: string[]
+  if (isExperiment || !rankingsEnabled) {
+    // For experiment periods, get students from access list
+    const accessList = await ctx.runQuery(internal.assignments.getAccessListForSolver, { periodId })
+    studentIds = accessList.map((a: any) => a.studentId)
+  } else {
+    // For normal periods, get students from preferences
+    studentIds = [...new Set(preferences.map((p: Doc<"preferences">) => p.studentId))]
+  }
+
+  if (studentIds.length === 0) {
+    throw new Error("No students to assign")
+  }
+
+  return { period, rankingsEnabled, preferences, topics, studentIds }
+}
+
+/**
+ * Loads solver context plus questionnaire data and builds the CP-SAT request body.
+ */
+async function buildSolverInput(
+  ctx: ActionCtx,
+  periodId: Id<"selectionPeriods">,
+  settings?: SolverSettings
+) {
+  const { period, rankingsEnabled, preferences, topics, studentIds } = await loadSolverContext(ctx, periodId)
+
+  const studentAnswers: Array<Doc<"studentAnswers">> = await ctx.runQuery(internal.assignments.getStudentAnswersForSolver, { periodId })
+  const questions: Array<Doc<"questions"> | null> = await ctx.runQuery(internal.assignments.getQuestionsForSolver, { periodId })
+
+  // Fetch categories for criterion types
+  const allCategories = await ctx.runQuery(internal.constraints.getAllConstraintsForSolver, {
+    semesterId: period.semesterId
+  })
+
+  const solverSettings = rankingsEnabled
+    ? settings
+    : settings
+      ? { ...settings, rankingPercentage: undefined }
+      : undefined
+
+  const cpSatInput = transformToCPSATFormat({
+    period,
+    preferences,
+    topics,
+    studentAnswers,
+    questions,
+    studentIds,
+    categories: allCategories,
+    settings: solverSettings
+  })
+
+  return { topics, preferences, studentIds, cpSatInput }
+}
+
 /**
  * Transforms Convex data to CP-SAT input format.
  */
@@ -370,10 +328,6 @@ function transformToCPSATFormat(data: {
 }) {
   const { period, preferences, topics, studentAnswers, questions, studentIds, categories, settings } = data
 
-  // Map student IDs to indices
-  const studentIdMap = new Map<string, number>()
-  studentIds.forEach((id, index) => studentIdMap.set(id, index))
-
   // Map topic IDs to indices
   const topicIdMap = new Map<Id<"topics">, number>()
   topics.forEach((topic, index) => topicIdMap.set(topic._id, index))
@@ -386,47 +340,38 @@ function transformToCPSATFormat(data: {
     }
   }
 
-  // Group student answers by student and aggregate by category
-  const studentValuesMap = new Map<string, Record<string, number>>()
-  
+  // Group student answers by student and aggregate by category (sum and count)
+  const studentTotalsMap = new Map<string, Map<string, { sum: number; count: number }>>()
+
   for (const answer of studentAnswers) {
     const question = questionMap.get(answer.questionId)
     if (!question) continue
 
-    if (!studentValuesMap.has(answer.studentId)) {
-      studentValuesMap.set(answer.studentId, {})
+    let totals = studentTotalsMap.get(answer.studentId)
+    if (!totals) {
+      totals = new Map()
+      studentTotalsMap.set(answer.studentId, totals)
     }
-    const values = studentValuesMap.get(answer.studentId)!
 
     // Use category if available, otherwise use question ID as key
     const key = question.category || answer.questionId
-    if (!values[key]) {
-      values[key] = 0
-    }
-    // Aggregate normalized answers by category (average)
-    // We'll count and sum, then divide later
-    if (!values[`${key}_count`]) {
-      values[`${key}_count`] = 0
-      values[`${key}_sum`] = 0
+    const total = totals.get(key)
+    if (total) {
+      total.sum += answer.normalizedAnswer
+      total.count += 1
+    } else {
+      totals.set(key, { sum: answer.normalizedAnswer, count: 1 })
     }
-    values[`${key}_count`] = (values[`${key}_count`] as number) + 1
-    values[`${key}_sum`] = (values[`${key}_sum`] as number) + answer.normalizedAnswer
   }
 
   // Calculate averages for categories
-  for (const [studentId, values] of studentValuesMap.entries()) {
-    for (const key of Object.keys(values)) {
-      if (key.endsWith("_count")) {
-        const categoryKey = key.replace("_count", "")
-        const count = values[key] as number
-        const sum = values[`${categoryKey}_sum`] as number
-        if (count > 0) {
-          values[categoryKey] = sum / count
-        }
-        delete values[key]
-        delete values[`${categoryKey}_sum`]
-      }
+  const studentValuesMap = new Map<string, Record<string, number>>()
+  for (const [studentId, totals] of studentTotalsMap.entries()) {
+    const values: Record<string, number> = {}
+    for (const [key, { sum, count }] of totals.entries()) {
+      values[key] = sum / count
     }
+    studentValuesMap.set(studentId, values)
   }
 
   // Build groups (topics) with criteria
@@ -440,19 +385,16 @@ function transformToCPSATFormat(data: {
       sizeOverrides.set(entry.topicId, entry.size)
     }
   }
-  type CriterionConfig = { type: string; min_ratio?: number }
   const groups = topics.map((topic, index) => ({
     id: index,
     size: sizeOverrides.get(topic._id) ?? (baseSize + (remainder-- > 0 ? 1 : 0)),
     criteria: {} as Record<string, CriterionConfig[]>
   }))
 
-  // Build category map by ID and name for lookup
+  // Build category map by ID for lookup
   const categoryMap = new Map<string, typeof categories[0]>()
-  const categoryByName = new Map<string, typeof categories[0]>()
   for (const cat of categories) {
     categoryMap.set(cat._id, cat)
-    categoryByName.set(cat.name, cat)
   }
 
   // 1. Apply balance distribution (minimize) categories from the selection period
@@ -483,38 +425,35 @@ function transformToCPSATFormat(data: {
 
       const group = groups[topicIndex]
 
-      if (category.criterionType === "prerequisite") {
-        const criterionConfig: CriterionConfig = {
-          type: "prerequisite",
-          min_ratio: category.minRatio ?? 0.5
-        }
-        group.criteria[category.name] = [criterionConfig]
-      } else if (category.criterionType === "pull") {
-        const criterionConfig: CriterionConfig = {
-          type: "pull"
-        }
-        group.criteria[category.name] = [criterionConfig]
+      const buildCriterion = TOPIC_CRITERION_BUILDERS[category.criterionType]
+      if (buildCriterion) {
+        group.criteria[category.name] = [buildCriterion(category)]
       }
     }
   }
 
+  // Index preferences by student for O(1) lookup
+  const preferenceByStudent = new Map<string, Doc<"preferences">>()
+  for (const pref of preferences) {
+    if (!preferenceByStudent.has(pref.studentId)) {
+      preferenceByStudent.set(pref.studentId, pref)
+    }
+  }
+
+  // Fallback for students without a usable preference, identical for everyone
+  const allGroups = topics.map((_, i) => i)
+
   // Build students with possible_groups from preferences
   const students = studentIds.map((studentId, index) => {
-    const pref = preferences.find((p: Doc<"preferences">) => p.studentId === studentId)
+    const pref = preferenceByStudent.get(studentId)
     const possibleGroups = pref
       ? pref.topicOrder
           .map((topicId: Id<"topics">) => topicIdMap.get(topicId))
           .filter((id: number | undefined): id is number => id !== undefined)
-      : topics.map((_, i) => i) // All groups if no preference
+      : allGroups // All groups if no preference
 
     // Get student values (aggregated by category)
-    const studentValues: Record<string, number> = {}
-    const values = studentValuesMap.get(studentId) || {}
-    for (const [key, value] of Object.entries(values)) {
-      if (typeof value === "number") {
-        studentValues[key] = value
-      }
-    }
+    const studentValues = studentValuesMap.get(studentId) ?? {}
 
     const rankings = pref && possibleGroups.length > 0
       ? Object.fromEntries(
@@ -528,7 +467,7 @@ function transformToCPSATFormat(data: {
 
     return {
       id: index,
-      possible_groups: possibleGroups.length > 0 ? possibleGroups : topics.map((_, i) => i),
+      possible_groups: possibleGroups.length > 0 ? possibleGroups : allGroups,
       values: studentValues,
       ...(rankings ? { rankings } : {})
     }
@@ -539,31 +478,27 @@ function transformToCPSATFormat(data: {
   const exclusions: Array<[number, number]> = []
   
   // Check if period description contains exclusion data in format: "EXCLUSIONS:[[0,1],[2,3]]"
-  if (data.period.description.includes("EXCLUSIONS:")) {
+  const exclusionsMatch = data.period.description.match(EXCLUSIONS_PATTERN)
+  if (exclusionsMatch && exclusionsMatch[1]) {
     try {
-      const match = data.period.description.match(/EXCLUSIONS:(\[\[.*?\]\])/)
-      if (match && match[1]) {
-        const parsedExclusions = JSON.parse(match[1]) as Array<[number, number]>
-        exclusions.push(...parsedExclusions)
-      }
+      const parsedExclusions = JSON.parse(exclusionsMatch[1]) as Array<[number, number]>
+      exclusions.push(...parsedExclusions)
     } catch (e) {
       console.warn("Failed to parse exclusion data from period description:", e)
     }
   }
 
   // Check if period description contains criteria data in format: "CRITERIA:{"0":{"Leader":[{"type":"best_min","min_ratio":0.5}]}}"
-  if (data.period.description.includes("CRITERIA:")) {
+  const criteriaMatch = data.period.description.match(CRITERIA_PATTERN)
+  if (criteriaMatch && criteriaMatch[1]) {
     try {
-      const match = data.period.description.match(/CRITERIA:(\{.*?\})/)
-      if (match && match[1]) {
-        const customCriteria = JSON.parse(match[1]) as Record<string, Record<string, CriterionConfig[]>>
-        for (const [groupIdStr, groupCriteria] of Object.entries(customCriteria)) {
-          const groupId = parseInt(groupIdStr)
-          const group = groups.find(g => g.id === groupId)
-          if (group) {
-            for (const [category, configs] of Object.entries(groupCriteria)) {
-              group.criteria[category] = configs
-            }
+      const customCriteria = JSON.parse(criteriaMatch[1]) as Record<string, Record<string, CriterionConfig[]>>
+      for (const [groupIdStr, groupCriteria] of Object.entries(customCriteria)) {
+        const groupId = parseInt(groupIdStr)
+        const group = groups[groupId] // Group ids are their topic indices
+        if (group) {
+          for (const [category, configs] of Object.entries(groupCriteria)) {
+            group.criteria[category] = configs
           }
         }
       }
@@ -604,15 +539,28 @@ function transformFromCPSATFormat(
   preferences: Array<Doc<"preferences">>,
   studentIds: string[]
 ): AssignmentResult {
-  // Build preference map for rank lookup
-  const preferenceMap = new Map<string, Map<Id<"topics">, number>>()
+  // Build rank matrix indexed by [studentIndex][groupIndex], matching solver output.
+  // Indices of a duplicated studentId share one row, so every index sees its ranks.
+  const rankRowByStudent = new Map<string, Array<number | undefined>>()
+  const rankMatrix = studentIds.map((id) => {
+    let ranks = rankRowByStudent.get(id)
+    if (!ranks) {
+      ranks = new Array(topics.length)
+      rankRowByStudent.set(id, ranks)
+    }
+    return ranks
+  })
+  const topicIndexMap = new Map<Id<"topics">, number>()
+  topics.forEach((topic, index) => topicIndexMap.set(topic._id, index))
 
   for (const pref of preferences) {
-    if (!preferenceMap.has(pref.studentId)) {
-      preferenceMap.set(pref.studentId, new Map())
-    }
+    const ranks = rankRowByStudent.get(pref.studentId)
+    if (!ranks) continue
     pref.topicOrder.forEach((topicId: Id<"topics">, index: number) => {
-      preferenceMap.get(pref.studentId)!.set(topicId, index + 1)
+      const groupIndex = topicIndexMap.get(topicId)
+      if (groupIndex !== undefined) {
+        ranks[groupIndex] = index + 1
+      }
     })
   }
 
@@ -621,7 +569,7 @@ function transformFromCPSATFormat(
     const groupIndex = assignment.group_id ?? assignment.group ?? 0
     const studentId = studentIds[studentIndex]
     const topicId = topics[groupIndex]._id
-    const rank = preferenceMap.get(studentId)?.get(topicId)
+    const rank = rankMatrix[studentIndex]?.[groupIndex]
 
     return { studentId, topicId, rank }
   });
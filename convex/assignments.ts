@@ -231,17 +231,18 @@ async function assignPeriodInternal(
   // Create batch ID
   const batchId = Assignment.createBatchId(periodId)
 
-  // Insert all assignments
-  for (const assignment of assignments) {
-    await ctx.db.insert("assignments", Assignment.make({
+  // Insert all assignments as one batch
+  const assignedAt = Date.now()
+  await Promise.all(assignments.map(assignment =>
+    ctx.db.insert("assignments", Assignment.make({
       periodId,
       batchId,
       studentId: assignment.studentId,
       topicId: assignment.topicId,
-      assignedAt: Date.now(),
+      assignedAt,
       originalRank: assignment.rank
     }))
-  }
+  ))
 
   // Update period status to assigned
   await ctx.db.replace(periodId, SelectionPeriod.assign(batchId)(
@@ -649,17 +650,18 @@ export const saveCPSATAssignments = internalMutation({
     // Create batch ID
     const batchId = Assignment.createBatchId(args.periodId)
 
-    // Insert all assignments
-    for (const assignment of args.assignments) {
-      await ctx.db.insert("assignments", Assignment.make({
+    // Insert all assignments as one batch
+    const assignedAt = Date.now()
+    await Promise.all(args.assignments.map(assignment =>
+      ctx.db.insert("assignments", Assignment.make({
         periodId: args.periodId,
         batchId,
         studentId: assignment.studentId,
         topicId: assignment.topicId,
-        assignedAt: Date.now(),
+        assignedAt,
         originalRank: assignment.rank
       }))
-    }
+    ))
 
     // Update period status to assigned
     await ctx.db.replace(args.periodId, SelectionPeriod.assign(batchId)(